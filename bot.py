@@ -1,13 +1,20 @@
 import asyncio
+import concurrent.futures
 import logging
 import os
+import sys
+import threading
+import time
 from collections import deque
 from dataclasses import dataclass
+from itertools import islice
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Optional
+from urllib.parse import parse_qs, urlparse
 
 import discord
 import yt_dlp
+from cachetools import TTLCache
 from discord.ext import commands
 from dotenv import load_dotenv
 
@@ -19,19 +26,127 @@ load_dotenv(PROJECT_ROOT / ".env")
 YTDL_OPTIONS = {
     "format": "bestaudio/best",
     "noplaylist": True,
+    "extract_flat": "in_playlist",
     "quiet": True,
     "default_search": "ytsearch",
     "source_address": "0.0.0.0",
+    "socket_timeout": 10,
+    "retries": 2,
+    "extractor_retries": 2,
 }
 
 FFMPEG_EXECUTABLE = os.getenv("FFMPEG_EXECUTABLE", "ffmpeg")
 
 FFMPEG_OPTIONS = {
-    "before_options": "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
-    "options": "-vn",
+    "before_options": "-nostdin -probesize 32 -analyzeduration 0 -multiple_requests 1 -reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5",
+    "options": "-vn -threads 1",
 }
 
-ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+# 20ms frames read from ffmpeg before a track is handed to the voice client.
+PREBUFFER_FRAMES = 25
+# Seconds to wait for those frames before giving up on a stalled stream.
+PREBUFFER_TIMEOUT = 15
+# Prebuffering blocks on ffmpeg output, so it runs on its own pool and can never
+# take threads away from yt-dlp extraction.
+PREBUFFER_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=8, thread_name_prefix="prebuffer")
+
+# One YoutubeDL per executor thread; instances carry mutable state (caches,
+# cookie jar) that isn't meant to be shared between threads.
+_ytdl_local = threading.local()
+
+# yt-dlp extraction blocks on network I/O for seconds at a time, so it gets its
+# own pool instead of starving the loop's default executor.
+YTDL_MAX_WORKERS = 4
+YTDL_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=YTDL_MAX_WORKERS, thread_name_prefix="ytdl")
+YTDL_SEMAPHORE = asyncio.Semaphore(YTDL_MAX_WORKERS)
+
+# Expected yt-dlp failures (bad links, removed or region-locked videos) that only
+# need a message back to the user, not a logged traceback.
+YTDL_ERRORS = (
+    yt_dlp.utils.DownloadError,
+    yt_dlp.utils.ExtractorError,
+    yt_dlp.utils.GeoRestrictedError,
+)
+
+# Trimmed extraction results keyed by normalized search string.
+TRACK_INFO_CACHE = TTLCache(maxsize=512, ttl=1800)
+# Cached stream URLs closer than this to their expiry are re-extracted.
+STREAM_URL_MIN_LIFETIME = 60
+# Extractions currently running, so concurrent requests for the same search share one.
+INFLIGHT_EXTRACTIONS: dict[str, asyncio.Task] = {}
+
+
+def is_url(search: str) -> bool:
+    search = search.strip()
+    if search.startswith(("http://", "https://")):
+        return True
+    # yt-dlp also resolves scheme-less links such as "youtu.be/<id>"; their paths are case-sensitive.
+    return ("/" in search or "." in search) and not any(char.isspace() for char in search)
+
+
+def normalize_search(search: str) -> str:
+    search = search.strip()
+    if is_url(search):
+        return search
+    return search.lower()
+
+
+def stream_url_expiring(stream_url: str) -> bool:
+    expire = parse_qs(urlparse(stream_url).query).get("expire")
+    if not expire:
+        return False
+    try:
+        return int(expire[0]) - time.time() < STREAM_URL_MIN_LIFETIME
+    except ValueError:
+        return False
+
+
+def get_ytdl() -> yt_dlp.YoutubeDL:
+    ytdl = getattr(_ytdl_local, "ytdl", None)
+    if ytdl is None:
+        ytdl = _ytdl_local.ytdl = yt_dlp.YoutubeDL(YTDL_OPTIONS)
+    return ytdl
+
+
+def pick_audio_format(formats: list[dict]) -> Optional[dict]:
+    audio_formats = [
+        fmt
+        for fmt in formats
+        if fmt.get("url")
+        and fmt.get("acodec") != "none"
+        and fmt.get("vcodec") == "none"
+        and yt_dlp.utils.determine_protocol(fmt) in ("http", "https")
+    ]
+    # Rank like yt-dlp's "bestaudio": the original language and preferred variants
+    # first (multi-language uploads carry dubbed tracks), bitrate only breaks ties.
+    return max(
+        audio_formats,
+        key=lambda fmt: (fmt.get("language_preference") or 0, fmt.get("preference") or 0, fmt.get("abr") or 0),
+        default=None,
+    )
+
+
+def extract_stream_info(url: str) -> dict:
+    # Skip yt-dlp's format selection and pick the best audio-only stream ourselves,
+    # falling back to full processing for anything that doesn't expose one.
+    ytdl = get_ytdl()
+    data = ytdl.extract_info(url, download=False, process=False)
+    fmt = pick_audio_format(data.get("formats") or [])
+    if fmt is None:
+        data = ytdl.process_ie_result(data, download=False)
+    else:
+        data["url"] = fmt["url"]
+        data["acodec"] = fmt.get("acodec")
+    return resolve_first_entry(data)
+
+
+def resolve_first_entry(data: dict) -> dict:
+    # Playlists and searches come back as flat entries; only the first one is resolved.
+    if data.get("entries"):
+        data = data["entries"][0]
+    if data.get("_type") == "url":
+        return extract_stream_info(data["url"])
+    return data
 
 
 def format_duration(duration: Optional[float], is_live: bool) -> str:
@@ -42,74 +157,202 @@ def format_duration(duration: Optional[float], is_live: bool) -> str:
     duration = int(duration)
     minutes, seconds = divmod(duration, 60)
     hours, minutes = divmod(minutes, 60)
+    # Interned so the many tracks sharing a length (e.g. "3:45") share one string.
     if hours:
-        return f"{hours:d}:{minutes:02d}:{seconds:02d}"
-    return f"{minutes:d}:{seconds:02d}"
+        return sys.intern(f"{hours:d}:{minutes:02d}:{seconds:02d}")
+    return sys.intern(f"{minutes:d}:{seconds:02d}")
+
+
+class PrebufferedSource(discord.AudioSource):
+    # Reads the first frames ahead of time so ffmpeg's spawn and the initial
+    # HTTPS handshake happen before playback instead of as a silent start.
+    def __init__(self, inner: discord.AudioSource):
+        self.inner = inner
+        self.buffer: deque[bytes] = deque()
+
+    def prebuffer(self, frames: int) -> None:
+        for _ in range(frames):
+            frame = self.inner.read()
+            if not frame:
+                break
+            self.buffer.append(frame)
+
+    def read(self) -> bytes:
+        if self.buffer:
+            return self.buffer.popleft()
+        return self.inner.read()
+
+    def is_opus(self) -> bool:
+        return self.inner.is_opus()
+
+    def cleanup(self) -> None:
+        self.inner.cleanup()
 
 
-@dataclass
+@dataclass(slots=True)
 class MusicTrack:
-    source: discord.AudioSource
+    # Extraction result; the audio source is only built from it right before playback.
+    info: dict
     title: str
     webpage_url: str
     duration: str
     requester: discord.Member
+    # Where playback failures are reported, since they happen after "Queued" was sent.
+    channel: discord.abc.Messageable
+
+
+MAX_QUEUE_LENGTH = 100
+
+# !queue lists at most this many upcoming tracks, and Discord rejects embed
+# field values longer than EMBED_FIELD_LIMIT characters.
+UPCOMING_MAX_TRACKS = 15
+EMBED_FIELD_LIMIT = 1024
+
+
+def fit_embed_field(title: str, render: Callable[[str], str]) -> str:
+    # Titles and URLs have no length cap: shorten the title until the rendered value
+    # fits an embed field, then hard-clip if the rest alone still doesn't.
+    text = render(title)
+    overflow = len(text) - EMBED_FIELD_LIMIT
+    if overflow <= 0:
+        return text
+    title = title[: max(len(title) - overflow - 1, 0)] + "…"
+    return render(title)[:EMBED_FIELD_LIMIT]
+
+
+def format_upcoming_line(index: int, track: MusicTrack, title: str) -> str:
+    return f"{index}. [{title}]({track.webpage_url}) • {track.duration} — requested by {track.requester.display_name}"
 
 
 class MusicPlayer:
     def __init__(self, bot: commands.Bot, guild_id: int):
         self.bot = bot
         self.guild_id = guild_id
-        self.queue: asyncio.Queue[MusicTrack] = asyncio.Queue()
         self.pending: deque[MusicTrack] = deque()
         self.current: Optional[MusicTrack] = None
         self.voice_client: Optional[discord.VoiceClient] = None
-        self.next = asyncio.Event()
-        self.player_task = bot.loop.create_task(self.player_loop())
+        # Rendered "Up next" text; None whenever pending has changed since the last render.
+        self._upcoming_text: Optional[str] = None
+        # Bumped by clear() so a track being prepared when the queue is stopped is dropped.
+        self._generation = 0
+        # Only runs while the guild has tracks queued; idle guilds keep no task alive.
+        self.player_task: Optional[asyncio.Task] = None
 
     async def player_loop(self) -> None:
-        await self.bot.wait_until_ready()
-        while not self.bot.is_closed():
-            self.next.clear()
-            try:
-                track = await self.queue.get()
-            except asyncio.CancelledError:
-                break
-
-            if self.pending:
-                self.pending.popleft()
-
+        loop = asyncio.get_running_loop()
+        while self.pending and not self.bot.is_closed():
+            track = self.pending.popleft()
+            self._upcoming_text = None
             self.current = track
+            generation = self._generation
             voice = self.voice_client
 
             if voice is None or not voice.is_connected():
                 logging.warning("Voice client missing for guild %s; dropping track '%s'", self.guild_id, track.title)
-                track.source.cleanup()
                 self.current = None
                 continue
 
+            try:
+                source = await create_track_source(track)
+            except YTDL_ERRORS as exc:
+                logging.warning("Could not refresh audio for '%s' in guild %s: %s", track.title, self.guild_id, exc)
+                await self.skip_track(track)
+                continue
+            except asyncio.TimeoutError:
+                logging.warning("Timed out buffering '%s' in guild %s", track.title, self.guild_id)
+                await self.skip_track(track)
+                continue
+            except discord.ClientException as exc:
+                # e.g. "ffmpeg was not found."
+                logging.warning("Could not start '%s' in guild %s: %s", track.title, self.guild_id, exc)
+                await self.skip_track(track, str(exc))
+                continue
+            except Exception:  # pylint: disable=broad-except
+                logging.exception("Unexpected error while starting '%s' in guild %s", track.title, self.guild_id)
+                await self.skip_track(track)
+                continue
+
+            # Building the source can take seconds; the queue may have been stopped
+            # or the bot disconnected in the meantime.
+            voice = self.voice_client
+            if generation != self._generation or voice is None or not voice.is_connected():
+                source.cleanup()
+                self.current = None
+                continue
+
+            done: asyncio.Future[Optional[Exception]] = loop.create_future()
+
+            def finish(error: Optional[Exception]) -> None:
+                if not done.done():
+                    done.set_result(error)
+
+            # Runs on discord.py's audio thread.
             def after_playback(error: Optional[Exception]) -> None:
-                if error:
-                    logging.exception("Playback error: %s", error)
-                track.source.cleanup()
-                self.bot.loop.call_soon_threadsafe(self.next.set)
+                source.cleanup()
+                loop.call_soon_threadsafe(finish, error)
 
-            voice.play(track.source, after=after_playback)
-            await self.next.wait()
+            try:
+                voice.play(source, after=after_playback)
+            except discord.ClientException as exc:
+                logging.warning("Could not start '%s' in guild %s: %s", track.title, self.guild_id, exc)
+                source.cleanup()
+                await self.skip_track(track, str(exc))
+                continue
+            error = await done
+            if error:
+                logging.error("Playback error in guild %s: %s", self.guild_id, error, exc_info=error)
             self.current = None
 
-    async def enqueue(self, track: MusicTrack) -> None:
+    async def skip_track(self, track: MusicTrack, reason: Optional[str] = None) -> None:
+        self.current = None
+        message = f"Couldn't play **{discord.utils.escape_markdown(track.title[:200])}**, skipping."
+        if reason:
+            message = f"{message} ({reason})"
+        try:
+            await track.channel.send(message)
+        except discord.HTTPException as exc:
+            logging.warning("Could not report skipped track in guild %s: %s", self.guild_id, exc)
+
+    def ensure_capacity(self) -> None:
+        if len(self.pending) >= MAX_QUEUE_LENGTH:
+            raise commands.CommandError(f"The queue is full ({MAX_QUEUE_LENGTH} tracks). Wait for some to finish before adding more.")
+
+    def enqueue(self, track: MusicTrack) -> None:
+        self.ensure_capacity()
         self.pending.append(track)
-        await self.queue.put(track)
+        self._upcoming_text = None
+        if self.player_task is None or self.player_task.done():
+            self.player_task = self.bot.loop.create_task(self.player_loop())
 
     def clear(self) -> None:
-        while not self.queue.empty():
-            try:
-                track = self.queue.get_nowait()
-            except asyncio.QueueEmpty:
-                break
-            track.source.cleanup()
         self.pending.clear()
+        self._upcoming_text = None
+        self._generation += 1
+
+    def upcoming_text(self) -> str:
+        if self._upcoming_text is None:
+            upcoming_lines = [
+                format_upcoming_line(index, track, track.title)
+                for index, track in enumerate(islice(self.pending, UPCOMING_MAX_TRACKS), start=1)
+            ]
+            while True:
+                text = self._join_upcoming(upcoming_lines)
+                if len(text) <= EMBED_FIELD_LIMIT or len(upcoming_lines) <= 1:
+                    break
+                upcoming_lines.pop()
+
+            if len(text) > EMBED_FIELD_LIMIT:
+                track = self.pending[0]
+                text = fit_embed_field(track.title, lambda title: self._join_upcoming([format_upcoming_line(1, track, title)]))
+            self._upcoming_text = text
+        return self._upcoming_text
+
+    def _join_upcoming(self, upcoming_lines: list[str]) -> str:
+        text = "\n".join(upcoming_lines)
+        hidden = len(self.pending) - len(upcoming_lines)
+        if hidden:
+            text += f"\n... and {hidden} more"
+        return text
 
     def teardown(self) -> None:
         self.clear()
@@ -125,12 +368,16 @@ class MusicBot(commands.Bot):
         self.players: dict[int, MusicPlayer] = {}
 
     def get_player(self, guild: discord.Guild) -> MusicPlayer:
-        player = self.players.get(guild.id)
+        player = self.players.get(guild_id := guild.id)
         if player is None:
-            player = MusicPlayer(self, guild.id)
-            self.players[guild.id] = player
+            player = self.players[guild_id] = MusicPlayer(self, guild_id)
         return player
 
+    async def setup_hook(self) -> None:
+        # Load libopus at startup instead of on the audio thread during the first playback.
+        if not discord.opus.is_loaded() and not discord.opus._load_default():  # pylint: disable=protected-access
+            logging.warning("Could not load libopus; audio sources that need Opus encoding will fail to play.")
+
     async def on_ready(self) -> None:
         logging.info("Logged in as %s (ID: %s)", self.user, self.user.id if self.user else "unknown")
 
@@ -138,30 +385,88 @@ class MusicBot(commands.Bot):
 bot = MusicBot()
 
 
-async def create_track(ctx: commands.Context, search: str) -> MusicTrack:
+async def fetch_track_info(search: str) -> dict:
+    key = normalize_search(search)
+    info = TRACK_INFO_CACHE.get(key)
+    if info is not None and not stream_url_expiring(info["url"]):
+        return info
+
+    task = INFLIGHT_EXTRACTIONS.get(key)
+    if task is None:
+        task = asyncio.ensure_future(extract_track_info(key, search))
+        INFLIGHT_EXTRACTIONS[key] = task
+        task.add_done_callback(lambda _: INFLIGHT_EXTRACTIONS.pop(key, None))
+    # Shielded so one cancelled requester doesn't abort the extraction for the others.
+    return await asyncio.shield(task)
+
+
+async def extract_track_info(key: str, search: str) -> dict:
     loop = asyncio.get_running_loop()
 
     def extract() -> dict:
-        return ytdl.extract_info(search, download=False)
+        if is_url(search):
+            return extract_stream_info(search)
+        return resolve_first_entry(get_ytdl().extract_info(search, download=False))
+
+    async with YTDL_SEMAPHORE:
+        data = await loop.run_in_executor(YTDL_EXECUTOR, extract)
+
+    # Only keep what playback needs; the full info dict can be megabytes.
+    info = {
+        "url": data["url"],
+        "title": data.get("title", "Unknown title"),
+        "webpage_url": data.get("webpage_url", data.get("original_url", search)),
+        "is_live": data.get("is_live", False),
+        "duration": data.get("duration"),
+        "acodec": data.get("acodec"),
+    }
+    TRACK_INFO_CACHE[key] = info
+    # Also key by the canonical page so the same video reached through another link,
+    # or re-resolved later by create_track_source, hits the cache.
+    TRACK_INFO_CACHE[normalize_search(info["webpage_url"])] = info
+    return info
+
+
+async def create_audio_source(stream_url: str, acodec: Optional[str]) -> discord.AudioSource:
+    # Let ffmpeg hand discord.py Opus packets directly: Opus streams are copied as-is,
+    # anything else is encoded natively by ffmpeg instead of per frame in Python.
+    if acodec and acodec != "none":
+        return discord.FFmpegOpusAudio(stream_url, codec=acodec, executable=FFMPEG_EXECUTABLE, **FFMPEG_OPTIONS)
+    return await discord.FFmpegOpusAudio.from_probe(stream_url, method="fallback", executable=FFMPEG_EXECUTABLE, **FFMPEG_OPTIONS)
+
+
+async def create_track_source(track: MusicTrack) -> discord.AudioSource:
+    # Stream URLs expire, so a track that waited long in the queue is re-resolved first.
+    if stream_url_expiring(track.info["url"]):
+        track.info = await fetch_track_info(track.webpage_url)
+
+    audio_source = PrebufferedSource(await create_audio_source(track.info["url"], track.info["acodec"]))
+    try:
+        await asyncio.wait_for(
+            asyncio.get_running_loop().run_in_executor(PREBUFFER_EXECUTOR, audio_source.prebuffer, PREBUFFER_FRAMES),
+            timeout=PREBUFFER_TIMEOUT,
+        )
+    except BaseException:
+        # Killing ffmpeg also unblocks a read still hanging in the executor thread.
+        audio_source.cleanup()
+        raise
+    return audio_source
 
-    data = await loop.run_in_executor(None, extract)
 
-    if "entries" in data and data["entries"]:
-        data = data["entries"][0]
+async def create_track(ctx: commands.Context, search: str) -> MusicTrack:
+    info = await fetch_track_info(search)
 
-    stream_url = data["url"]
-    title = data.get("title", "Unknown title")
-    webpage_url = data.get("webpage_url", data.get("original_url", search))
-    is_live = data.get("is_live", False)
-    duration = format_duration(data.get("duration"), is_live)
+    title = info["title"]
+    webpage_url = info["webpage_url"]
+    duration = format_duration(info["duration"], info["is_live"])
 
-    audio_source = discord.FFmpegPCMAudio(stream_url, executable=FFMPEG_EXECUTABLE, **FFMPEG_OPTIONS)
     return MusicTrack(
-        source=audio_source,
+        info=info,
         title=title,
         webpage_url=webpage_url,
         duration=duration,
         requester=ctx.author,
+        channel=ctx.channel,
     )
 
 
@@ -196,15 +501,16 @@ async def join(ctx: commands.Context) -> None:
 async def play(ctx: commands.Context, *, query: str) -> None:
     try:
         await ensure_voice(ctx)
+        player = bot.get_player(ctx.guild)
+        player.ensure_capacity()
     except commands.CommandError as exc:
         await ctx.send(str(exc))
         return
 
-    player = bot.get_player(ctx.guild)
-
     try:
         track = await create_track(ctx, query)
-    except yt_dlp.utils.DownloadError:
+    except YTDL_ERRORS as exc:
+        logging.info("Could not retrieve audio for %r: %s", query, exc)
         await ctx.send("Could not retrieve audio from that link.")
         return
     except Exception as exc:  # pylint: disable=broad-except
@@ -212,7 +518,12 @@ async def play(ctx: commands.Context, *, query: str) -> None:
         await ctx.send("Something went wrong while processing your request.")
         return
 
-    await player.enqueue(track)
+    try:
+        # The queue may have filled up while the track was being resolved.
+        player.enqueue(track)
+    except commands.CommandError as exc:
+        await ctx.send(str(exc))
+        return
 
     embed = discord.Embed(title="Queued", description=f"[{track.title}]({track.webpage_url})", color=discord.Color.blurple())
     embed.add_field(name="Requested by", value=track.requester.mention)
@@ -273,18 +584,19 @@ async def show_queue(ctx: commands.Context) -> None:
 
     embed = discord.Embed(title="Music Queue", color=discord.Color.green())
 
-    if player.current:
+    current = player.current
+    if current:
         embed.add_field(
             name="Now playing",
-            value=f"[{player.current.title}]({player.current.webpage_url}) • {player.current.duration}\nRequested by {player.current.requester.mention}",
+            value=fit_embed_field(
+                current.title,
+                lambda title: f"[{title}]({current.webpage_url}) • {current.duration}\nRequested by {current.requester.mention}",
+            ),
             inline=False,
         )
 
     if player.pending:
-        upcoming_lines = []
-        for index, track in enumerate(player.pending, start=1):
-            upcoming_lines.append(f"{index}. [{track.title}]({track.webpage_url}) • {track.duration} — requested by {track.requester.display_name}")
-        embed.add_field(name="Up next", value="\n".join(upcoming_lines), inline=False)
+        embed.add_field(name="Up next", value=player.upcoming_text(), inline=False)
 
     await ctx.send(embed=embed)
 